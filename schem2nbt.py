@@ -1,23 +1,33 @@
 import argparse
+import gzip
 import logging
 import multiprocessing
 import os
-import re
-from math import floor
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from queue import Empty
 from typing import Union
 
+import numpy as np
 from nbtlib import CompoundSchema, File, load, schema
 from nbtlib.tag import Compound, Int, List, String
 from tqdm import tqdm
 
 SCHEMATIC_VERSION = 2586
+PROGRESS_BATCH_SIZE = 1024
+# Level 9 spends most of its time searching for slightly longer matches, 3 is far faster for a small size cost
+COMPRESSION_LEVEL = 3
 
 
-def structure_schema() -> CompoundSchema:
+@lru_cache(maxsize=1)
+def structure_schema() -> type[CompoundSchema]:
     """Generate a structure schema.
 
+    The schema is built once and cached, instantiate it to get a new structure.
+
     Returns:
-        CompoundSchema: The structure schema.
+        type[CompoundSchema]: The structure schema.
     """
     return schema(
         "Structure",
@@ -45,7 +55,7 @@ def structure_schema() -> CompoundSchema:
                 )
             ],
         },
-    )()
+    )
 
 
 def get_schematic_size(worldedit: File) -> dict[str, int]:
@@ -73,7 +83,7 @@ def initiate_schema(worldedit: File) -> CompoundSchema:
     Returns:
         CompoundSchema: The structure file.
     """
-    nbt_schematic: CompoundSchema = structure_schema()
+    nbt_schematic: CompoundSchema = structure_schema()()
     nbt_schematic["DataVersion"] = SCHEMATIC_VERSION
     nbt_schematic["palette"] = []
     nbt_schematic["blocks"] = []
@@ -94,7 +104,40 @@ def get_block_palette(worldedit: File) -> dict[int, str]:
     Returns:
         dict[int, str]: A dictionary of block palette entries.
     """
-    return {int(v): k for k, v in dict(worldedit["Palette"]).items()}
+    return {int(v): k for k, v in worldedit["Palette"].items()}
+
+
+@lru_cache(maxsize=None)
+def parse_block(block: str) -> tuple[str, tuple[tuple[str, str], ...]]:
+    """Parses a block state string into its name and properties.
+
+    Args:
+        block (str): The block state, e.g. "minecraft:oak_log[axis=y]".
+
+    Returns:
+        tuple[str, tuple[tuple[str, str], ...]]: A tuple containing the block name and its property name/value pairs.
+    """
+    if "[" not in block:
+        return block, ()
+    block_name, block_properties = block.removesuffix("]").split("[", 1)
+    return block_name, tuple(
+        tuple(block_property.split("=", 1))
+        for block_property in block_properties.split(",")
+        if block_property
+    )
+
+
+@lru_cache(maxsize=256)
+def string_tag(value: str) -> String:
+    """Gets a shared String tag for a value, as block properties reuse a handful of values like "true" or "north".
+
+    Args:
+        value (str): The value of the tag.
+
+    Returns:
+        String: The String tag.
+    """
+    return String(value)
 
 
 def process_block_palette(
@@ -109,101 +152,175 @@ def process_block_palette(
     Returns:
         tuple[CompoundSchema, dict]: A tuple containing the structure file and the new palette.
     """
+    palette_type = nbt_schematic.schema["palette"]
+    state_type = palette_type.subtype
+
+    palette = []
     new_palette = {}
     for _palette, block in byte_palette.items():
-        block_name, block_properties = re.findall(r"(minecraft:\w+)(\[.+\])?", block)[0]
-        block_properties = re.findall(r"((\w+)=(\w+))", block_properties)
-        bp = {}
-        for block_property in block_properties:
-            bp[block_property[1]] = String(block_property[2])
+        block_name, block_properties = parse_block(block)
+        bp = Compound()
+        for name, value in block_properties:
+            bp[name] = string_tag(value)
         if len(bp) > 0:
-            nbt_schematic["palette"].append({"Name": block_name, "Properties": bp})
+            palette.append(state_type({"Name": String(block_name), "Properties": bp}))
         else:
-            nbt_schematic["palette"].append({"Name": block_name})
-        new_palette[block] = len(nbt_schematic["palette"]) - 1
+            palette.append(state_type({"Name": String(block_name)}))
+        new_palette[block] = len(palette) - 1
+    nbt_schematic["palette"] = palette_type(palette)
 
     return nbt_schematic, new_palette
 
 
-def process_block_entities(worldedit: File) -> dict[str, Compound]:
+def get_state_lut(
+    byte_palette: dict[int, str], new_palette: dict[str, int]
+) -> np.ndarray:
+    """Builds a lookup table mapping worldedit block ids to structure palette states.
+
+    Args:
+        byte_palette (dict[int, str]): The old block palette from world edit.
+        new_palette (dict[str, int]): The new block palette to use.
+
+    Returns:
+        np.ndarray: An array where the value at a block id is its state in the structure palette, or -1 if the id isn't in the palette.
+    """
+    state_lut = np.full(max(byte_palette) + 1, -1, dtype=np.int32)
+    for block_id, block in byte_palette.items():
+        state_lut[block_id] = new_palette[block]
+    return state_lut
+
+
+def get_block_positions(
+    block_count: int, size: dict[str, int]
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Computes the position of every block in a worldedit schematic's block data.
+
+    Args:
+        block_count (int): The number of blocks in the block data.
+        size (dict[str, int]): The size of the schematic, as returned by get_schematic_size.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: The x, y and z coordinates of each block.
+    """
+    ys, remainder = np.divmod(np.arange(block_count), size["z"] * size["x"])
+    zs, xs = np.divmod(remainder, size["z"])
+    return xs, ys, zs
+
+
+def process_block_entities(
+    worldedit: File, size: dict[str, int]
+) -> dict[int, Compound]:
     """Processes block entities from a worldedit schematic file and returns them as a dictionary.
 
         Args:
     worldedit (nbtlib.File): The worldedit schematic file.
+    size (dict[str, int]): The size of the schematic, as returned by get_schematic_size.
 
             Returns:
-    dict[str, Compound]: A dictionary of block entities.
+    dict[int, Compound]: A dictionary of block entities, keyed by their index in the block data.
     """
     block_entities = {}
-    for data in worldedit["BlockEntities"].copy():
-        # Create a copy so we do not modify the worldedit file accidentally
-        data = data.copy()
-        key = f"{int(data['Pos'][0])} {int(data['Pos'][1])} {int(data['Pos'][2])}"
-        data["id"] = data["Id"]
-        del data["Id"]
-        del data["Pos"]
-        block_entities[key] = data
+    for data in worldedit["BlockEntities"]:
+        x, y, z = (int(coordinate) for coordinate in data["Pos"])
+        if not (0 <= x < size["z"] and 0 <= y < size["y"] and 0 <= z < size["x"]):
+            continue
+        key = (y * size["x"] + z) * size["z"] + x
+        # Build a new compound rather than editing the entity so the worldedit file is left untouched
+        block_entities[key] = Compound(
+            {
+                **{k: v for k, v in data.items() if k not in ("Id", "Pos")},
+                "id": data["Id"],
+            }
+        )
     return block_entities
 
 
 def process_blocks(
     worldedit: File,
+    size: dict[str, int],
     nbt_schematic: CompoundSchema,
     byte_palette: dict[int, str],
     new_palette: dict[str, int],
-    block_entities: dict[str, Compound] = {},
+    block_entities: dict[int, Compound] = {},
     queue: Union[multiprocessing.Queue, None] = None,
 ) -> CompoundSchema:
     """Processes blocks from a worldedit schematic file and returns them in a structure file format.
 
     Args:
         worldedit (File): The worldedit schematic file.
+        size (dict[str, int]): The size of the schematic, as returned by get_schematic_size.
         nbt_schematic (CompoundSchema): The structure file.
         byte_palette (dict[int, str]): The old block palette from world edit.
         new_palette (dict[str, int]): The new block palette to use.
         input_file (str, optional): The name of the input file, used for the loading bar. Defaults to "".
-        block_entities (dict[str, Compound], optional): The block entities. If empty, they will be devoid of nbt. Defaults to {}.
+        block_entities (dict[int, Compound], optional): The block entities. If empty, they will be devoid of nbt. Defaults to {}.
         queue (Union[multiprocessing.Queue, None], optional): The queue to use for the loading bar. Defaults to None.
 
     Returns:
         CompoundSchema: The structure file.
     """
-    size: dict[str, int] = get_schematic_size(worldedit)
-
-    for i in range(len(worldedit["BlockData"])):
-        x = floor((i % (size["z"] * size["x"])) % size["z"])
-        y = floor(i / (size["z"] * size["x"]))
-        z = floor((i % (size["z"] * size["x"])) / size["z"])
-        key: str = f"{x} {y} {z}"
-
-        block_id = int(worldedit["BlockData"][i])
-
-        try:
-            block: str = byte_palette[block_id]
-        except KeyError:
-            block: str = byte_palette[0]
+    block_ids = np.asarray(worldedit["BlockData"], dtype=np.int32)
+    xs, ys, zs = get_block_positions(block_ids.size, size)
+    if queue:
+        queue.put((block_ids.size, 0))
+
+    state_lut = get_state_lut(byte_palette, new_palette)
+    in_range = (block_ids >= 0) & (block_ids < state_lut.size)
+    states = state_lut[np.where(in_range, block_ids, 0)]
+    unknown = ~in_range | (states == -1)
+    if unknown.any():
+        for i in np.flatnonzero(unknown):
             logging.warning(
-                f"We couldn't process the block at {key}: Block {block_id} doesn't exist. Defaulting to block 0 ({block})."
+                f"We couldn't process the block at {xs[i]} {ys[i]} {zs[i]}: Block {block_ids[i]} doesn't exist. Defaulting to block 0 ({byte_palette[0]})."
             )
-
-        if key in block_entities:
-            nbt_schematic["blocks"].append(
-                {
-                    "state": new_palette[block],
-                    "pos": [x, y, z],
-                    "nbt": block_entities[key],
-                }
+        states[unknown] = new_palette[byte_palette[0]]
+
+    # Build the tags with the schema's own types so assigning them skips per-block coercion
+    block_list_type = nbt_schematic.schema["blocks"]
+    block_type = block_list_type.subtype
+
+    blocks = [None] * block_ids.size
+    # Build the blocks in batches so progress is reported without a queue message per block
+    for start in range(0, block_ids.size, PROGRESS_BATCH_SIZE):
+        stop = min(start + PROGRESS_BATCH_SIZE, block_ids.size)
+        blocks[start:stop] = [
+            block_type(
+                {"state": Int(state), "pos": List[Int]([Int(x), Int(y), Int(z)])}
             )
-        else:
-            nbt_schematic["blocks"].append(
-                {"state": new_palette[block], "pos": [x, y, z]}
+            for x, y, z, state in zip(
+                xs[start:stop].tolist(),
+                ys[start:stop].tolist(),
+                zs[start:stop].tolist(),
+                states[start:stop].tolist(),
             )
+        ]
         if queue:
-            queue.put(True)
+            queue.put((0, stop - start))
+
+    # Block entities are rare, so attach them afterwards rather than checking every block for one
+    for i, block_entity in block_entities.items():
+        blocks[i]["nbt"] = block_entity
+
+    nbt_schematic["blocks"] = block_list_type(blocks)
 
     return nbt_schematic
 
 
+def save_structure(nbt_schematic: CompoundSchema, output_file: str) -> None:
+    """Saves a structure file as gzipped nbt.
+
+    Args:
+        nbt_schematic (CompoundSchema): The structure file.
+        output_file (str): The path to save the structure file to.
+    """
+    # Writing every tag straight into a gzip stream costs a Python-level call per tag,
+    # so serialize to memory first and compress the whole buffer at once
+    buffer = BytesIO()
+    File({"": nbt_schematic}).write(buffer)
+    with open(output_file, "wb") as f:
+        f.write(gzip.compress(buffer.getbuffer(), COMPRESSION_LEVEL))
+
+
 def process_file(
     input_file: str, output_file: str, queue=Union[multiprocessing.Queue, None]
 ) -> None:
@@ -216,28 +333,30 @@ def process_file(
     """
     logging.info(f"Processing {input_file}...")
     try:
-        with load(input_file) as worldedit:
-            nbt_schematic: CompoundSchema = initiate_schema(worldedit)
+        # Not used as a context manager, as that would save the input file back on exit
+        worldedit = load(input_file)
+        nbt_schematic: CompoundSchema = initiate_schema(worldedit)
 
-            block_entities = process_block_entities(worldedit)
+        size: dict[str, int] = get_schematic_size(worldedit)
 
-            byte_palette = get_block_palette(worldedit)
+        block_entities = process_block_entities(worldedit, size)
 
-            nbt_schematic, new_palette = process_block_palette(
-                nbt_schematic, byte_palette
-            )
+        byte_palette = get_block_palette(worldedit)
 
-            nbt_schematic = process_blocks(
-                worldedit=worldedit,
-                nbt_schematic=nbt_schematic,
-                byte_palette=byte_palette,
-                new_palette=new_palette,
-                block_entities=block_entities,
-                queue=queue,  # type: ignore - The type checker doesn't like multiprocessing.Queue
-            )
+        nbt_schematic, new_palette = process_block_palette(nbt_schematic, byte_palette)
+
+        nbt_schematic = process_blocks(
+            worldedit=worldedit,
+            size=size,
+            nbt_schematic=nbt_schematic,
+            byte_palette=byte_palette,
+            new_palette=new_palette,
+            block_entities=block_entities,
+            queue=queue,  # type: ignore - The type checker doesn't like multiprocessing.Queue
+        )
 
         logging.info(f"Saving {output_file}...")
-        File({"": Compound(nbt_schematic)}, gzipped=True).save(output_file)
+        save_structure(nbt_schematic, output_file)
     except Exception as e:
         logging.error(f"An error occurred while processing {input_file}: {repr(e)}")
 
@@ -249,29 +368,27 @@ def process_files(input_files: list[str], output_files: list[str]) -> None:
         input_files (list[str]): The input files.
         output_files (list[str]): The output files.
     """
-    queue = multiprocessing.Queue()
-    processes = []
-
-    total_blocks = 0
-    for input_file in input_files:
-        with load(input_file) as worldedit:
-            total_blocks += len(worldedit["BlockData"])
-
-    with tqdm(total=total_blocks, desc="Blocks processed") as pbar:
-        for input_file, output_file in zip(input_files, output_files):
-            process = multiprocessing.Process(
-                target=process_file, args=(input_file, output_file, queue)
-            )
-            processes.append(process)
-            process.start()
-
-        while any(process.is_alive() for process in processes):
-            while not queue.empty():
-                queue.get()
-                pbar.update()
+    with multiprocessing.Manager() as manager, ProcessPoolExecutor(
+        max_workers=os.cpu_count()
+    ) as executor, tqdm(total=0, desc="Blocks processed") as pbar:
+        # A managed queue can be pickled into the pool's workers, unlike multiprocessing.Queue
+        queue = manager.Queue()
+        futures = [
+            executor.submit(process_file, input_file, output_file, queue)
+            for input_file, output_file in zip(input_files, output_files)
+        ]
 
-        for process in processes:
-            process.join()
+        # Block on the queue instead of spinning so the main process doesn't take a core away from the workers
+        while not all(future.done() for future in futures) or not queue.empty():
+            try:
+                blocks_found, blocks_processed = queue.get(timeout=0.1)
+            except Empty:
+                continue
+            # Workers report their block count themselves so the inputs don't have to be loaded twice
+            if blocks_found:
+                pbar.total += blocks_found
+                pbar.refresh()
+            pbar.update(blocks_processed)
 
         pbar.close()
 
@@ -294,15 +411,13 @@ def process_paths(args: argparse.Namespace) -> tuple[list[str], list[str]]:
         if not args.output:
             args.output = args.input
         os.makedirs(args.output, exist_ok=True)
-        file_list = [
-            f
-            for f in os.listdir(args.input)
-            if os.path.isfile(os.path.join(args.input, f))
-        ]
-        input_files = [os.path.join(args.input, f) for f in file_list]
+        # scandir entries cache their file type, so this doesn't stat every file again
+        with os.scandir(args.input) as it:
+            entries = [entry for entry in it if entry.is_file()]
+        input_files = [entry.path for entry in entries]
         output_files = [
-            os.path.join(args.output, f"{os.path.splitext(f)[0]}.nbt")
-            for f in file_list
+            os.path.join(args.output, f"{os.path.splitext(entry.name)[0]}.nbt")
+            for entry in entries
         ]
     else:
         # input_path is a file or doesn't exist